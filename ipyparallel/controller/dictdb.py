@@ -94,6 +94,18 @@ class BaseDB(LoggingConfigurable):
     def close(self):
         pass
 
+    def add_records(self, records):
+        """Add many Task Records, from an iterable of (msg_id, rec) pairs."""
+        for msg_id, rec in records:
+            self.add_record(msg_id, rec)
+
+    def iter_records(self, check, keys=None):
+        """Iterate over records matching a query dict.
+
+        Backends that can fetch records incrementally should override this.
+        """
+        return iter(self.find_records(check, keys))
+
 
 class DictDB(BaseDB):
     """Basic in-memory dict-based object for saving Task Records.
@@ -83,6 +83,19 @@ def ensure_date_is_parsed(header):
         header['date'] = parse_date(header['date'])
 
 
+def values_conflict(evalue, rvalue):
+    """Whether an existing record value conflicts with a new one
+
+    The db may return dates nested in dicts (e.g. header['date']) as strings,
+    so they are parsed before comparing.
+    """
+    if not (evalue and rvalue):
+        return False
+    if isinstance(evalue, dict) and isinstance(rvalue, dict):
+        return extract_dates(evalue) != extract_dates(rvalue)
+    return evalue != rvalue
+
+
 def init_record(msg):
     """Initialize a TaskRecord based on a request."""
     header = msg['header']
@@ -475,7 +488,7 @@ class Hub(LoggingConfigurable):
             existing = self.db.get_record(msg_id)
             for key, evalue in existing.items():
                 rvalue = record.get(key, None)
-                if evalue and rvalue and evalue != rvalue:
+                if values_conflict(evalue, rvalue):
                     self.log.warning(
                         "conflicting initial state for record: %r:%r <%r> %r",
                         msg_id,
@@ -672,7 +685,7 @@ class Hub(LoggingConfigurable):
                     # don't compare buffers
                     continue
                 rvalue = record.get(key, None)
-                if evalue and rvalue and evalue != rvalue:
+                if values_conflict(evalue, rvalue):
                     self.log.warning(
                         "conflicting initial state for record: %r:%r <%r> %r",
                         msg_id,
@@ -1389,13 +1402,32 @@ class Hub(LoggingConfigurable):
         content['pending'] = pending
         content['completed'] = completed
         buffers = []
+        # the parts of records needed for the reply, by msg_id
+        results = {}
         if not statusonly:
+            keys = [
+                'completed',
+                'header',
+                'metadata',
+                'result_metadata',
+                'result_header',
+                'result_content',
+                'received',
+                'result_buffers',
+                'execute_input',
+                'execute_result',
+                'error',
+                'stdout',
+                'stderr',
+            ]
             try:
-                matches = self.db.find_records(dict(msg_id={'$in': msg_ids}))
-                # turn match list into dict, for faster lookup
-                records = {}
-                for rec in matches:
-                    records[rec['msg_id']] = rec
+                # extract each record as it is fetched,
+                # rather than holding every matching record at once
+                for rec in self.db.iter_records(dict(msg_id={'$in': msg_ids}), keys):
+                    results[rec['msg_id']] = (
+                        rec['completed'],
+                        self._extract_record(rec),
+                    )
             except Exception:
                 content = error.wrap_exception()
                 self.log.exception("Failed to get results")
@@ -1407,21 +1439,19 @@ class Hub(LoggingConfigurable):
                     ident=client_id,
                 )
                 return
-        else:
-            records = {}
         for msg_id in msg_ids:
             if msg_id in self.pending:
                 pending.append(msg_id)
             elif msg_id in self.all_completed:
                 completed.append(msg_id)
                 if not statusonly:
-                    c, bufs = self._extract_record(records[msg_id])
+                    c, bufs = results[msg_id][1]
                     content[msg_id] = c
                     buffers.extend(bufs)
-            elif msg_id in records:
-                if rec['completed']:
+            elif msg_id in results:
+                is_completed, (c, bufs) = results[msg_id]
+                if is_completed:
                     completed.append(msg_id)
-                    c, bufs = self._extract_record(records[msg_id])
                     content[msg_id] = c
                     buffers.extend(bufs)
                 else:
@@ -3,19 +3,32 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 import json
+import mmap
 import os
+import queue
+import struct
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from urllib.parse import quote
 
 try:
-    import cPickle as pickle
+    import sqlite3
 except ImportError:
-    import pickle
+    sqlite3 = None
 
-from datetime import datetime
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 try:
-    import sqlite3
+    import orjson
 except ImportError:
-    sqlite3 = None
+    orjson = None
 
 from dateutil.parser import parse as dateutil_parse
 
@@ -25,7 +38,17 @@ except ImportError:
     from jupyter_client.jsonutil import date_default as json_default
 
 from tornado import ioloop
-from traitlets import Dict, Instance, List, Unicode
+from traitlets import (
+    Bool,
+    CaselessStrEnum,
+    Dict,
+    Float,
+    Instance,
+    Integer,
+    List,
+    Unicode,
+    default,
+)
 
 from ..util import ensure_timezone, extract_dates
 from .dictdb import BaseDB
@@ -53,39 +76,237 @@ null_operators = {
     '!=': "IS NOT NULL",
 }
 
+# how a test's value is passed as query arguments
+_NO_ARGS = 0
+_ONE_ARG = 1
+_EXTEND_ARGS = 2
+
+
+def _value_shape(value):
+    """The part of a test's value that affects the SQL expression"""
+    if value is None:
+        return None
+    elif isinstance(value, (tuple, list)):
+        return (len(value), any(v is None for v in value))
+    else:
+        return '?'
+
+
+@lru_cache(maxsize=128)
+def _compile_expression(shape):
+    """Compile the shape of a mongodb-style query into an SQL expression
+
+    shape is a tuple of (name, test, value_shape) for each test in the query,
+    where test is None for an equality check.
+
+    Returns the expression and, for each test,
+    how its value is passed as arguments.
+    """
+    expressions = []
+    arg_kinds = []
+    for name, test, value_shape in shape:
+        if test is None:
+            # it's an equality check
+            if value_shape is None:
+                expressions.append(f"{name} IS NULL")
+                arg_kinds.append(_NO_ARGS)
+            else:
+                expressions.append(f"{name} = ?")
+                arg_kinds.append(_ONE_ARG)
+            continue
+
+        try:
+            op = operators[test]
+        except KeyError:
+            raise KeyError(f"Unsupported operator: {test!r}")
+        join = None
+        if isinstance(op, tuple):
+            op, join = op
+
+        if value_shape is None and op in null_operators:
+            expr = f"{name} {null_operators[op]}"
+            arg_kinds.append(_NO_ARGS)
+        else:
+            expr = f"{name} {op} ?"
+            if isinstance(value_shape, tuple):
+                n, has_null = value_shape
+                if join is None:
+                    raise ValueError(f"{test!r} test does not take a list")
+                if op in null_operators and has_null:
+                    # equality tests don't work with NULL
+                    raise ValueError(
+                        f"Cannot use {test!r} test with NULL values on SQLite backend"
+                    )
+                expr = f'( {join.join([expr] * n)} )'
+                arg_kinds.append(_EXTEND_ARGS)
+            else:
+                arg_kinds.append(_ONE_ARG)
+        expressions.append(expr)
+
+    return " AND ".join(expressions), tuple(arg_kinds)
+
+
+if msgpack is not None:
+    # msgpack encodes/decodes in C and stores bytes without base64
+    _dict_type = 'dict msgpack'
+
+    def _adapt_dict(d):
+        try:
+            return msgpack.packb(d, default=json_default, use_bin_type=True)
+        except OverflowError:
+            # integers larger than 64 bits are stored as JSON instead.
+            # msgpack never encodes a dict starting with '{',
+            # so the converter can tell them apart.
+            return json.dumps(d, default=json_default).encode('utf8')
+
+    def _convert_dict(ds):
+        if ds is None:
+            return ds
+        elif ds[:1] == b'{':
+            return json.loads(ds)
+        else:
+            return msgpack.unpackb(ds, raw=False, strict_map_key=False)
+
+elif orjson is not None:
+    # orjson encodes in C, and handles datetimes without calling json_default
+    _dict_type = 'dict text'
+    _orjson_options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def _adapt_dict(d):
+        try:
+            b = orjson.dumps(d, default=json_default, option=_orjson_options)
+            # decode, so the column stores text, like the json fallback
+            return b.decode('utf8')
+        except orjson.JSONEncodeError:
+            # e.g. integers larger than 64 bits
+            return json.dumps(d, default=json_default)
+
+    def _convert_dict(ds):
+        if ds is None:
+            return ds
+        else:
+            return orjson.loads(ds)
+
+else:
+    _dict_type = 'dict text'
+
+    def _adapt_dict(d):
+        return json.dumps(d, default=json_default)
+
+    def _convert_dict(ds):
+        if ds is None:
+            return ds
+        else:
+            if isinstance(ds, bytes):
+                # If I understand the sqlite doc correctly, this will always be utf8
+                ds = ds.decode('utf8')
+            return json.loads(ds)
+
+
+class _Dict(dict):
+    """A dict to be stored in a dict column
+
+    The sqlite adapter for the dict columns' format is registered for this type.
+    Dicts stored in other columns, such as error, are stored as JSON text.
+    """
+
+    __slots__ = ()
 
-def _adapt_dict(d):
+
+def _adapt_text_dict(d):
+    """Adapt a dict stored in a text column to JSON"""
     return json.dumps(d, default=json_default)
 
 
-def _convert_dict(ds):
-    if ds is None:
-        return ds
-    else:
-        if isinstance(ds, bytes):
-            # If I understand the sqlite doc correctly, this will always be utf8
-            ds = ds.decode('utf8')
-        return extract_dates(json.loads(ds))
-
-
-def _adapt_bufs(bufs):
-    # this is *horrible*
-    # copy buffers into single list and pickle it:
-    if bufs and isinstance(bufs[0], (bytes, memoryview)):
-        return sqlite3.Binary(
-            pickle.dumps([memoryview(buf).tobytes() for buf in bufs], -1)
-        )
-    elif bufs:
-        return bufs
-    else:
+# lists of buffers are stored as a single blob:
+# a header with the number of buffers and each of their lengths,
+# followed by the buffers themselves.
+# Large buffer lists are written to a file in the same format,
+# and the column only stores the file's name, after a special count.
+_bufs_type = 'bufs packed blob'
+_bufs_count = struct.Struct('<I')
+_BUFS_IN_FILE = 0xFFFFFFFF
+_buffer_keys = ('buffers', 'result_buffers')
+
+
+def _byte_view(buf):
+    """A flat memoryview of bytes for a buffer"""
+    view = memoryview(buf)
+    if not view.c_contiguous:
+        # cast only works on contiguous memory
+        view = memoryview(view.tobytes())
+    return view.cast('B')
+
+
+def _bufs_header(views):
+    """The packed header for a list of byte memoryviews"""
+    return struct.pack(f'<I{len(views)}Q', len(views), *(v.nbytes for v in views))
+
+
+# mapped files can't be removed on Windows while their buffers are in use,
+# so the buffers are copied out of the file instead
+_MMAP_BUFS = os.name != 'nt'
+
+
+class _Bufs(list):
+    """A list of buffers to be stored in a bufs column, as flat byte memoryviews
+
+    The sqlite adapter is registered for this type rather than list,
+    so no other list is ever stored as buffers by accident.
+    """
+
+    __slots__ = ()
+
+
+class _BufsFile(str):
+    """The name of a file storing a list of buffers, read from a bufs column
+
+    The file is relative to the database's blob directory,
+    so it is loaded by the SQLiteDB instance, not the converter.
+    """
+
+    __slots__ = ()
+
+
+def _adapt_bufs(views):
+    if not views:
         return None
+    header = _bufs_header(views)
+    out = bytearray(len(header) + sum(view.nbytes for view in views))
+    out[: len(header)] = header
+    offset = len(header)
+    for view in views:
+        out[offset : offset + view.nbytes] = view
+        offset += view.nbytes
+    return sqlite3.Binary(out)
 
 
 def _convert_bufs(bs):
     if bs is None:
         return []
-    else:
-        return pickle.loads(bytes(bs))
+    (count,) = _bufs_count.unpack_from(bs)
+    if count == _BUFS_IN_FILE:
+        return _BufsFile(bs[_bufs_count.size :].decode('utf8'))
+    return _unpack_bufs(bs)
+
+
+def _unpack_bufs(bs):
+    """Unpack a packed list of buffers"""
+    (count,) = _bufs_count.unpack_from(bs)
+    lengths = struct.unpack_from(f'<{count}Q', bs, _bufs_count.size)
+    offset = _bufs_count.size + 8 * count
+    # slice views of the blob, rather than copying each buffer
+    view = memoryview(bs)
+    bufs = []
+    for length in lengths:
+        bufs.append(view[offset : offset + length])
+        offset += length
+    return bufs
+
+
+def _quote_identifier(name):
+    """Quote an SQL identifier, such as a table name"""
+    return '"{}"'.format(name.replace('"', '""'))
 
 
 def _adapt_timestamp(dt):
@@ -95,7 +316,14 @@ def _adapt_timestamp(dt):
 
 def _convert_timestamp(s):
     """Adapt text timestamp to datetime"""
-    return ensure_timezone(dateutil_parse(s))
+    if isinstance(s, bytes):
+        s = s.decode()
+    try:
+        # fast path: the output of _adapt_timestamp
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        dt = dateutil_parse(s)
+    return ensure_timezone(dt)
 
 
 # -----------------------------------------------------------------------------
@@ -125,6 +353,83 @@ class SQLiteDB(BaseDB):
         in tasks from previous sessions being available via Clients' db_query and
         get_result methods.""",
     )
+    max_pending_writes = Integer(
+        500,
+        config=True,
+        help="""The maximum number of writes to batch into a single transaction.
+
+        Writes are committed when this many are pending,
+        or after commit_interval, whichever comes first.
+        """,
+    )
+    commit_interval = Float(
+        2.0,
+        config=True,
+        help="""The maximum time (in seconds) to hold writes before committing them.""",
+    )
+    parse_nested_dates = Bool(
+        False,
+        config=True,
+        help="""Whether to parse timestamp strings nested in dict columns (e.g. header)
+        back into datetime objects when reading records.
+
+        This walks every dict on every read, and clients parse the dates they use
+        themselves, so it is off by default.
+        The submitted, started, completed, and received columns
+        are always datetimes.
+        """,
+    )
+    blob_threshold = Integer(
+        64 * 1024,
+        config=True,
+        help="""Buffer lists larger than this many bytes are stored in files
+        next to the database, rather than in the database itself.
+
+        Large blobs slow down SQLite and bloat its write-ahead log.
+        Set to 0 to store all buffers in the database.
+        """,
+    )
+    reader_pool_size = Integer(
+        2,
+        config=True,
+        help="""The number of extra connections to keep open for reading records.
+
+        Reads use a pooled connection when there are no uncommitted writes,
+        so they do not contend with the connection used for writing.
+        Reads from other threads always wait for a pooled connection,
+        so at least one is opened.
+        """,
+    )
+    journal_mode = CaselessStrEnum(
+        ["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"],
+        default_value="WAL",
+        config=True,
+        help="""The SQLite journal mode for the task database.
+
+        Write-ahead logging (WAL) is fastest, and lets readers proceed while
+        a write is in progress, but does not work on network filesystems such as NFS.
+        Use DELETE (SQLite's own default) if the database is on a network filesystem.
+        """,
+    )
+    synchronous = CaselessStrEnum(
+        ["OFF", "NORMAL", "FULL", "EXTRA"],
+        config=True,
+        help="""The SQLite synchronous setting for the task database.
+
+        The default is NORMAL with write-ahead logging,
+        which is safe from corruption,
+        but the most recent transactions may be lost on power failure.
+        Use FULL if every committed transaction must survive power loss.
+        With other journal modes, the default is FULL.
+        """,
+    )
+
+    @default('synchronous')
+    def _default_synchronous(self):
+        if self.journal_mode == 'WAL':
+            return 'NORMAL'
+        # NORMAL is not safe from corruption with a rollback journal
+        return 'FULL'
 
     if sqlite3 is not None:
         _db = Instance('sqlite3.Connection', allow_none=True)
@@ -161,10 +466,10 @@ class SQLiteDB(BaseDB):
     _types = Dict(
         {
             'msg_id': 'text',
-            'header': 'dict text',
-            'metadata': 'dict text',
-            'content': 'dict text',
-            'buffers': 'bufs blob',
+            'header': _dict_type,
+            'metadata': _dict_type,
+            'content': _dict_type,
+            'buffers': _bufs_type,
             'submitted': 'timestamp',
             'client_uuid': 'text',
             'engine_uuid': 'text',
@@ -172,10 +477,10 @@ class SQLiteDB(BaseDB):
             'completed': 'timestamp',
             'resubmitted': 'text',
             'received': 'timestamp',
-            'result_header': 'dict text',
-            'result_metadata': 'dict text',
-            'result_content': 'dict text',
-            'result_buffers': 'bufs blob',
+            'result_header': _dict_type,
+            'result_metadata': _dict_type,
+            'result_content': _dict_type,
+            'result_buffers': _bufs_type,
             'queue': 'text',
             'execute_input': 'text',
             'execute_result': 'text',
@@ -204,75 +509,194 @@ class SQLiteDB(BaseDB):
                     self.location = '.'
             else:
                 self.location = '.'
-        self._init_db()
-
-        # register db commit as 2s periodic callback
-        # to prevent clogging pipes
+        # column names, as a tuple for fast iteration
+        self._key_tuple = tuple(self._keys)
+        # keys that may be used in queries
+        self._valid_check_keys = frozenset(self._keys)
+        # keys of dict columns
+        self._dict_keys = frozenset(
+            key for key in self._keys if self._types[key] == _dict_type
+        )
+        # an empty record, copied by _defaults
+        self._defaults_template = dict.fromkeys(self._keys)
+        # number of writes in the current transaction
+        self._pending = 0
+        # when the current transaction began
+        self._transaction_start = 0
+        # blob files to remove once the current transaction is committed
+        self._blob_removals = []
+        # the scheduled commit of the current transaction
         # assumes we are being run in a zmq ioloop app
-        self._commit_callback = pc = ioloop.PeriodicCallback(self._db.commit, 2000)
-        pc.start()
+        self._loop = ioloop.IOLoop.current()
+        self._flush_timeout = None
+        self._init_db()
 
     def close(self):
-        self._commit_callback.stop()
-        self._db.commit()
+        self._flush()
         self._db.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    @contextmanager
+    def _reader(self):
+        """Context manager for a connection to read records with
+
+        Uses the write connection when it has uncommitted writes,
+        since only it can see them.
+        Otherwise, borrows a connection from the reader pool.
+
+        Other threads never use the write connection,
+        and wait for a connection from the pool instead.
+        They only see committed records.
+        """
+        if threading.get_ident() != self._writer_thread:
+            db = self._pool.get()
+        elif self._db.in_transaction:
+            yield self._db
+            return
+        else:
+            try:
+                db = self._pool.get_nowait()
+            except queue.Empty:
+                # all readers are in use
+                yield self._db
+                return
+        try:
+            yield db
+        finally:
+            self._pool.put(db)
+
+    def _write(self, query, args=(), blob_removals=()):
+        """Execute a write in the current transaction
+
+        Writes are batched into a single transaction,
+        which is committed by _flush when it is big or old enough.
+        Nothing is scheduled while there are no writes.
+
+        blob_removals are blob files no longer referenced after this write.
+        They are removed after the transaction is committed,
+        so committed records never refer to missing files.
+        """
+        self._begin()
+        self._db.execute(query, args)
+        self._blob_removals.extend(blob_removals)
+        self._pending += 1
+        self._maybe_flush()
+
+    def _write_many(self, query, rows):
+        """Execute a write for each of many rows in the current transaction"""
+        self._begin()
+        cursor = self._db.executemany(query, rows)
+        self._pending += cursor.rowcount
+        self._maybe_flush()
+
+    def _begin(self):
+        """Begin a transaction, if one is not already in progress"""
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._transaction_start = time.monotonic()
+            self._flush_timeout = self._loop.call_later(
+                self.commit_interval, self._flush
+            )
+
+    def _maybe_flush(self):
+        """Commit pending writes if there are enough of them, or they are old enough"""
+        if (
+            self._pending >= self.max_pending_writes
+            or time.monotonic() - self._transaction_start >= self.commit_interval
+        ):
+            self._flush()
+
+    def _flush(self):
+        """Commit any pending writes"""
+        if self._flush_timeout is not None:
+            self._loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+        self._pending = 0
+        if self._blob_removals:
+            self._remove_blobs(self._blob_removals)
+            self._blob_removals = []
 
     def _defaults(self, keys=None):
         """create an empty record"""
-        d = {}
-        keys = self._keys if keys is None else keys
-        for key in keys:
-            d[key] = None
-        return d
+        if keys is None:
+            return self._defaults_template.copy()
+        return dict.fromkeys(keys)
 
-    def _check_table(self):
+    def _check_table(self, keys, types):
         """Ensure that an incorrect table doesn't exist
 
         If a bad (old) table does exist, return False
         """
-        cursor = self._db.execute(f"PRAGMA table_info('{self.table}')")
-        lines = cursor.fetchall()
-        if not lines:
+        cursor = self._db.execute(f"PRAGMA table_info({_quote_identifier(self.table)})")
+        # column name: declared type
+        actual = {line[1]: line[2] for line in cursor}
+        if not actual:
             # table does not exist
             return True
-        types = {}
-        keys = []
-        for line in lines:
-            keys.append(line[1])
-            types[line[1]] = line[2]
-        if self._keys != keys:
+        if list(actual) != keys:
             # key mismatch
             self.log.warning('keys mismatch')
             return False
-        for key in self._keys:
-            if types[key] != self._types[key]:
-                self.log.warning(
-                    f'type mismatch: {key}: {types[key]} != {self._types[key]}'
-                )
+        for key in keys:
+            # sqlite may normalize the case of standard types, e.g. text -> TEXT
+            if actual[key].lower() != types[key].lower():
+                self.log.warning(f'type mismatch: {key}: {actual[key]} != {types[key]}')
                 return False
         return True
 
+    def _connect(self):
+        """Open a new connection to the database"""
+        dbfile = os.path.join(self.location, self.filename)
+        db = sqlite3.connect(
+            dbfile,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # transactions are managed explicitly by _write/_flush
+            isolation_level=None,
+            cached_statements=256,
+            # connections may be used from worker threads
+            check_same_thread=False,
+        )
+        # rows can be turned into dicts by column name
+        db.row_factory = sqlite3.Row
+        # WAL (the default) avoids fsyncing a rollback journal on every commit,
+        # and lets readers proceed while a write is in progress
+        db.executescript(
+            f"""
+            PRAGMA journal_mode={self.journal_mode};
+            PRAGMA synchronous={self.synchronous};
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA busy_timeout=5000;
+            PRAGMA cache_size=-65536;
+            """
+        )
+        return db
+
     def _init_db(self):
         """Connect to the database and get new session number."""
         # register adapters
-        sqlite3.register_adapter(dict, _adapt_dict)
+        sqlite3.register_adapter(dict, _adapt_text_dict)
+        sqlite3.register_adapter(_Dict, _adapt_dict)
         sqlite3.register_converter('dict', _convert_dict)
-        sqlite3.register_adapter(list, _adapt_bufs)
+        sqlite3.register_adapter(_Bufs, _adapt_bufs)
         sqlite3.register_converter('bufs', _convert_bufs)
         sqlite3.register_adapter(datetime, _adapt_timestamp)
         sqlite3.register_converter('timestamp', _convert_timestamp)
         # connect to the db
-        dbfile = os.path.join(self.location, self.filename)
-        self._db = sqlite3.connect(
-            dbfile,
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            # isolation_level = None)#,
-            cached_statements=64,
-        )
-        # print dir(self._db)
+        self._db = self._connect()
+        # the write connection is only used from the thread that created it
+        self._writer_thread = threading.get_ident()
+        keys = list(self._keys)
+        types = dict(self._types)
         first_table = previous_table = self.table
         i = 0
-        while not self._check_table():
+        while not self._check_table(keys, types):
             i += 1
             self.table = f"{first_table}_{i}"
             self.log.warning(
@@ -280,155 +704,227 @@ class SQLiteDB(BaseDB):
             )
             previous_table = self.table
 
+        # column declarations are built from _types,
+        # so they always match what _check_table expects
+        columns = [f"{key} {types[key]}" for key in keys]
+        # msg_id is the first column
+        columns[0] += " PRIMARY KEY"
+        table = self._quoted_table = _quote_identifier(self.table)
         self._db.execute(
-            f"""CREATE TABLE IF NOT EXISTS '{self.table}'
-                (msg_id text PRIMARY KEY,
-                header dict text,
-                metadata dict text,
-                content dict text,
-                buffers bufs blob,
-                submitted timestamp,
-                client_uuid text,
-                engine_uuid text,
-                started timestamp,
-                completed timestamp,
-                resubmitted text,
-                received timestamp,
-                result_header dict text,
-                result_metadata dict text,
-                result_content dict text,
-                result_buffers bufs blob,
-                queue text,
-                execute_input text,
-                execute_result text,
-                error text,
-                stdout text,
-                stderr text)
+            f"""CREATE TABLE IF NOT EXISTS {table}
+                ({', '.join(columns)})
                 """
         )
-        self._db.commit()
-
-    def _dict_to_list(self, d):
-        """turn a mongodb-style record dict into a list."""
-
-        return [d[key] for key in self._keys]
+        indices = {
+            # for sorting history
+            'submitted': '(submitted, msg_id)',
+            # for purging an engine's completed results
+            'engine_completed': '(engine_uuid, completed)',
+        }
+        for suffix, index_columns in indices.items():
+            index = _quote_identifier(f"{self.table}_{suffix}")
+            self._db.execute(
+                f"CREATE INDEX IF NOT EXISTS {index} ON {table} {index_columns}"
+            )
 
-    def _list_to_dict(self, line, keys=None):
-        """Inverse of dict_to_list"""
-        keys = self._keys if keys is None else keys
-        d = self._defaults(keys)
-        for key, value in zip(keys, line):
-            d[key] = value
+        # directory for buffers stored outside the database,
+        # which columns refer to by name
+        self._blob_dir = os.path.abspath(
+            os.path.join(
+                self.location,
+                f"{self.filename}-blobs",
+                # table names can be anything, so make sure they are safe filenames
+                quote(self.table, safe=''),
+            )
+        )
 
+        # build the per-record queries once,
+        # so sqlite can reuse their prepared statements
+        placeholders = ','.join('?' * len(self._keys))
+        self._sql_insert = f"INSERT INTO {table} VALUES ({placeholders})"
+        self._sql_get = f"SELECT * FROM {table} WHERE msg_id==?"
+        self._sql_drop = f"DELETE FROM {table} WHERE msg_id==?"
+        # UPDATE queries, keyed by the sorted tuple of keys being updated
+        self._sql_updates = {}
+
+        self._pool = queue.SimpleQueue()
+        for i in range(max(self.reader_pool_size, 1)):
+            self._pool.put(self._connect())
+
+    def _row_to_dict(self, row):
+        """Turn a row read from the database into a record dict"""
+        d = dict(row)
+        for key in _buffer_keys:
+            if isinstance(d.get(key), _BufsFile):
+                d[key] = self._load_bufs(d['msg_id'], d[key])
+        if self.parse_nested_dates:
+            # converters are shared by all instances,
+            # so nested dates are parsed here
+            for key in self._dict_keys:
+                if key in d:
+                    d[key] = extract_dates(d[key])
         return d
 
     def _render_expression(self, check):
         """Turn a mongodb-style search dict into an SQL query."""
-        expressions = []
-        args = []
-
-        skeys = set(check.keys())
-        skeys.difference_update(set(self._keys))
-        skeys.difference_update({'buffers', 'result_buffers'})
-        if skeys:
-            raise KeyError(f"Illegal testing key(s): {skeys}")
+        bad_keys = check.keys() - self._valid_check_keys
+        if bad_keys:
+            raise KeyError(f"Illegal testing key(s): {bad_keys}")
 
+        # queries often repeat with different values,
+        # so compile by shape and fill in the values
+        shape = []
+        values = []
         for name, sub_check in check.items():
             if isinstance(sub_check, dict):
                 for test, value in sub_check.items():
-                    try:
-                        op = operators[test]
-                    except KeyError:
-                        raise KeyError(f"Unsupported operator: {test!r}")
-                    if isinstance(op, tuple):
-                        op, join = op
-
-                    if value is None and op in null_operators:
-                        expr = f"{name} {null_operators[op]}"
-                    else:
-                        expr = f"{name} {op} ?"
-                        if isinstance(value, (tuple, list)):
-                            if op in null_operators and any([v is None for v in value]):
-                                # equality tests don't work with NULL
-                                raise ValueError(
-                                    f"Cannot use {test!r} test with NULL values on SQLite backend"
-                                )
-                            expr = f'( {join.join([expr] * len(value))} )'
-                            args.extend(value)
-                        else:
-                            args.append(value)
-                    expressions.append(expr)
+                    shape.append((name, test, _value_shape(value)))
+                    values.append(value)
             else:
-                # it's an equality check
-                if sub_check is None:
-                    expressions.append(f"{name} IS NULL")
-                else:
-                    expressions.append(f"{name} = ?")
-                    args.append(sub_check)
+                shape.append((name, None, _value_shape(sub_check)))
+                values.append(sub_check)
 
-        expr = " AND ".join(expressions)
+        expr, arg_kinds = _compile_expression(tuple(shape))
+        args = []
+        for value, kind in zip(values, arg_kinds):
+            if kind == _ONE_ARG:
+                args.append(value)
+            elif kind == _EXTEND_ARGS:
+                args.extend(value)
         return expr, args
 
-    def add_record(self, msg_id, rec):
-        """Add a new Task Record, by msg_id."""
+    def _store_bufs(self, msg_id, key, bufs):
+        """Prepare a list of buffers to be stored, writing large ones to a file
+
+        Returns the value to store in the column:
+        the buffers themselves if they are small,
+        otherwise a reference to the file.
+        """
+        if not bufs:
+            return None
+        views = _Bufs(_byte_view(buf) for buf in bufs)
+        if (
+            not self.blob_threshold
+            or sum(view.nbytes for view in views) <= self.blob_threshold
+        ):
+            return views
+        os.makedirs(self._blob_dir, exist_ok=True)
+        # every write gets a new file, so the file of the committed record
+        # is only replaced once the new one is committed.
+        # msg_ids come from clients, so make sure they are safe filenames
+        name = f"{quote(msg_id, safe='')}.{key}.{uuid.uuid4().hex}"
+        with open(os.path.join(self._blob_dir, name), 'wb') as f:
+            f.write(_bufs_header(views))
+            for view in views:
+                f.write(view)
+        return sqlite3.Binary(_bufs_count.pack(_BUFS_IN_FILE) + name.encode('utf8'))
+
+    def _load_bufs(self, msg_id, name):
+        """Load a list of buffers stored in a file"""
+        try:
+            with open(os.path.join(self._blob_dir, name), 'rb') as f:
+                if _MMAP_BUFS:
+                    bs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    bs = f.read()
+        except FileNotFoundError:
+            self.log.warning("Missing buffers for %s: %s", msg_id, name)
+            return []
+        return _unpack_bufs(bs)
+
+    def _blob_files(self, expr, args, keys=_buffer_keys):
+        """The names of blob files referred to by records matching an expression"""
+        if not os.path.isdir(self._blob_dir):
+            # no buffers have been stored in files
+            return []
+        # only select the names of files, without converting buffers stored inline
+        selects = [
+            f"""SELECT substr({key}, {_bufs_count.size + 1}) FROM {self._quoted_table}
+                WHERE ({expr}) AND substr({key}, 1, {_bufs_count.size}) = ?"""
+            for key in keys
+        ]
+        marker = _bufs_count.pack(_BUFS_IN_FILE)
+        query = " UNION ALL ".join(selects)
+        # the write connection sees uncommitted writes
+        rows = self._db.execute(query, [*args, marker] * len(keys))
+        return [row[0].decode('utf8') for row in rows]
+
+    def _remove_blobs(self, names):
+        """Remove blob files"""
+        for name in names:
+            try:
+                os.remove(os.path.join(self._blob_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.log.warning("Failed to remove buffers %s: %s", name, e)
+
+    def _column_value(self, msg_id, key, value):
+        """Prepare a record's value to be stored in its column"""
+        if key in _buffer_keys:
+            return self._store_bufs(msg_id, key, value)
+        elif key in self._dict_keys and isinstance(value, dict):
+            return _Dict(value)
+        return value
+
+    def _record_to_list(self, msg_id, rec):
+        """Turn a new record into a row to insert"""
         d = self._defaults()
         d.update(rec)
         d['msg_id'] = msg_id
-        line = self._dict_to_list(d)
-        tups = '({})'.format(','.join(['?'] * len(line)))
-        self._db.execute(f"INSERT INTO '{self.table}' VALUES {tups}", line)
-        # self._db.commit()
+        return [self._column_value(msg_id, key, d[key]) for key in self._key_tuple]
+
+    def add_record(self, msg_id, rec):
+        """Add a new Task Record, by msg_id."""
+        self._write(self._sql_insert, self._record_to_list(msg_id, rec))
+
+    def add_records(self, records):
+        """Add many Task Records, from an iterable of (msg_id, rec) pairs."""
+        self._write_many(
+            self._sql_insert,
+            (self._record_to_list(msg_id, rec) for msg_id, rec in records),
+        )
 
     def get_record(self, msg_id):
         """Get a specific Task Record, by msg_id."""
-        cursor = self._db.execute(
-            f"""SELECT * FROM '{self.table}' WHERE msg_id==?""", (msg_id,)
-        )
-        line = cursor.fetchone()
-        if line is None:
+        with self._reader() as db:
+            row = db.execute(self._sql_get, (msg_id,)).fetchone()
+        if row is None:
             raise KeyError(f"No such msg: {msg_id!r}")
-        return self._list_to_dict(line)
+        return self._row_to_dict(row)
 
     def update_record(self, msg_id, rec):
         """Update the data in an existing record."""
-        query = f"UPDATE '{self.table}' SET "
-        sets = []
-        keys = sorted(rec.keys())
-        values = []
-        for key in keys:
-            sets.append(f'{key} = ?')
-            values.append(rec[key])
-        query += ', '.join(sets)
-        query += ' WHERE msg_id == ?'
+        keys = tuple(sorted(rec.keys()))
+        query = self._sql_updates.get(keys)
+        if query is None:
+            sets = ', '.join(f'{key} = ?' for key in keys)
+            query = f"UPDATE {self._quoted_table} SET {sets} WHERE msg_id == ?"
+            self._sql_updates[keys] = query
+        values = [self._column_value(msg_id, key, rec[key]) for key in keys]
         values.append(msg_id)
-        self._db.execute(query, values)
-        # self._db.commit()
+        buffer_keys = [key for key in keys if key in _buffer_keys]
+        if buffer_keys:
+            # the buffers being replaced
+            replaced = self._blob_files("msg_id == ?", (msg_id,), buffer_keys)
+        else:
+            replaced = ()
+        self._write(query, values, replaced)
 
     def drop_record(self, msg_id):
         """Remove a record from the DB."""
-        self._db.execute(f"""DELETE FROM '{self.table}' WHERE msg_id==?""", (msg_id,))
-        # self._db.commit()
+        blobs = self._blob_files("msg_id == ?", (msg_id,))
+        self._write(self._sql_drop, (msg_id,), blobs)
 
     def drop_matching_records(self, check):
         """Remove a record from the DB."""
         expr, args = self._render_expression(check)
-        query = f"DELETE FROM '{self.table}' WHERE {expr}"
-        self._db.execute(query, args)
-        # self._db.commit()
+        blobs = self._blob_files(expr, args)
+        query = f"DELETE FROM {self._quoted_table} WHERE {expr}"
+        self._write(query, args, blobs)
 
-    def find_records(self, check, keys=None):
-        """Find records matching a query dict, optionally extracting subset of keys.
-
-        Returns list of matching records.
-
-        Parameters
-        ----------
-        check : dict
-            mongodb-style query argument
-        keys : list of strs [optional]
-            if specified, the subset of keys to extract.  msg_id will *always* be
-            included.
-        """
+    def _find_query(self, check, keys=None):
+        """Build the SELECT query and arguments for find_records"""
         if keys:
             bad_keys = [key for key in keys if key not in self._keys]
             if bad_keys:
@@ -443,21 +939,58 @@ class SQLiteDB(BaseDB):
         else:
             req = '*'
         expr, args = self._render_expression(check)
-        query = f"""SELECT {req} FROM '{self.table}' WHERE {expr}"""
-        cursor = self._db.execute(query, args)
-        matches = cursor.fetchall()
-        records = []
-        for line in matches:
-            rec = self._list_to_dict(line, keys)
-            records.append(rec)
-        return records
+        query = f"""SELECT {req} FROM {self._quoted_table} WHERE {expr}"""
+        return query, args
+
+    def _iter_rows(self, query, args):
+        """Yield the results of a query as dicts, one at a time"""
+        with self._reader() as db:
+            for row in db.execute(query, args):
+                yield self._row_to_dict(row)
+
+    def iter_records(self, check, keys=None):
+        """Iterate over records matching a query dict.
+
+        Like find_records, but records are fetched from the database
+        one at a time as they are consumed, instead of all at once.
+        The query is checked immediately, so bad queries raise here.
+
+        Until it is exhausted or closed, the iterator holds a connection
+        from the reader pool, and its read snapshot blocks WAL checkpoints.
+        Use contextlib.closing if it may not be consumed entirely.
+
+        Parameters
+        ----------
+        check : dict
+            mongodb-style query argument
+        keys : list of strs [optional]
+            if specified, the subset of keys to extract.  msg_id will *always* be
+            included.
+        """
+        query, args = self._find_query(check, keys)
+        return self._iter_rows(query, args)
+
+    def find_records(self, check, keys=None):
+        """Find records matching a query dict, optionally extracting subset of keys.
+
+        Returns list of matching records.
+
+        Parameters
+        ----------
+        check : dict
+            mongodb-style query argument
+        keys : list of strs [optional]
+            if specified, the subset of keys to extract.  msg_id will *always* be
+            included.
+        """
+        return list(self.iter_records(check, keys))
 
     def get_history(self):
         """get all msg_ids, ordered by time submitted."""
-        query = f"""SELECT msg_id FROM '{self.table}' ORDER by submitted ASC"""
-        cursor = self._db.execute(query)
-        # will be a list of length 1 tuples
-        return [tup[0] for tup in cursor.fetchall()]
+        query = f"""SELECT msg_id FROM {self._quoted_table} ORDER by submitted ASC"""
+        with self._reader() as db:
+            # rows of length 1
+            return [row[0] for row in db.execute(query)]
 
 
 __all__ = ['SQLiteDB']
@@ -2,20 +2,25 @@
 
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
+import json
 import logging
 import os
+import shutil
+import sqlite3
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import pytest
 from jupyter_client.session import Session
 
 from ipyparallel import util
+from ipyparallel.controller import sqlitedb
 from ipyparallel.controller.dictdb import DictDB
-from ipyparallel.controller.hub import init_record
-from ipyparallel.controller.sqlitedb import SQLiteDB
+from ipyparallel.controller.hub import init_record, values_conflict
+from ipyparallel.controller.sqlitedb import SQLiteDB, _convert_timestamp
 from ipyparallel.util import utc
 
 
@@ -50,6 +55,21 @@ class TaskDBTest:
         assert len(after) == len(before) + 5
         assert after[:-5] == before
 
+    def test_add_records(self):
+        before = self.db.get_history()
+        records = []
+        for i in range(5):
+            msg = self.session.msg('apply_request', content=dict(a=5))
+            msg['buffers'] = [os.urandom(10)]
+            records.append((msg['header']['msg_id'], init_record(msg)))
+        self.db.add_records(records)
+        after = self.db.get_history()
+        assert after[:-5] == before
+        assert set(after[-5:]) == {msg_id for msg_id, rec in records}
+        rec = self.db.get_record(records[-1][0])
+        assert rec['msg_id'] == records[-1][0]
+        assert rec['content'] == dict(a=5)
+
     def test_drop_record(self):
         msg_id = self.load_records()[-1]
         rec = self.db.get_record(msg_id)
@@ -119,6 +139,16 @@ class TaskDBTest:
         for rec in found:
             assert 'msg_id' in rec.keys()
 
+    def test_iter_records(self):
+        hist = self.db.get_history()
+        query = {'msg_id': {'$in': hist[:3]}}
+        it = self.db.iter_records(query, keys=['submitted'])
+        found = list(it)
+        assert {rec['msg_id'] for rec in found} == set(hist[:3])
+        assert found == self.db.find_records(query, keys=['submitted'])
+        with pytest.raises(KeyError):
+            self.db.iter_records({'msg_id': {'$in': hist}}, keys=['nosuchkey'])
+
     def test_find_records_in(self):
         """test finding records with '$in','$nin' operators"""
         hist = self.db.get_history()
@@ -170,6 +200,42 @@ class TaskDBTest:
         recs = self.db.find_records(query)
         assert len(recs) >= 10
 
+    def test_buffers(self):
+        """lists of buffers are stored and retrieved"""
+        bufs = [
+            b'',
+            os.urandom(10),
+            memoryview(os.urandom(5)),
+            # not contiguous
+            memoryview(os.urandom(10))[::2],
+            b'abc',
+        ]
+        msg_id = self.load_records(1)[-1]
+        self.db.update_record(msg_id, {'result_buffers': bufs})
+        rec = self.db.get_record(msg_id)
+        assert [bytes(b) for b in rec['result_buffers']] == [bytes(b) for b in bufs]
+        assert len(rec['buffers']) == 1
+
+    def test_big_int(self):
+        """integers too large for 64 bits are stored"""
+        msg_id = self.load_records(1)[-1]
+        self.db.update_record(msg_id, {'content': {'x': 2**70, 'y': -(2**70)}})
+        rec = self.db.get_record(msg_id)
+        assert rec['content'] == {'x': 2**70, 'y': -(2**70)}
+
+    def test_existing_record_not_conflicting(self):
+        """a stored record doesn't conflict with the request it came from"""
+        msg = self.session.msg('apply_request', content=dict(a=5))
+        msg['buffers'] = []
+        msg_id = msg['header']['msg_id']
+        self.db.add_record(msg_id, init_record(msg))
+        existing = self.db.get_record(msg_id)
+        record = init_record(msg)
+        for key, evalue in existing.items():
+            if not key.endswith('buffers'):
+                assert not values_conflict(evalue, record[key]), key
+        assert values_conflict(existing['content'], {'a': 6})
+
     def test_pop_safe_get(self):
         """editing query results shouldn't affect record [get]"""
         msg_id = self.db.get_history()[-1]
@@ -291,3 +357,336 @@ class TestSQLiteBackend(TaskDBTest, TestCase):
             os.remove(self.temp_db)
         except Exception:
             pass
+        shutil.rmtree(self.temp_db + '-blobs', ignore_errors=True)
+
+    def test_table_format_mismatch(self):
+        """an existing table in an old format is not reused"""
+        table = self.db.table
+        self.db.close()
+        db = sqlite3.connect(self.temp_db)
+        db.execute(f"DROP TABLE '{table}'")
+        db.execute(f"CREATE TABLE '{table}' (msg_id text PRIMARY KEY, header text)")
+        db.commit()
+        db.close()
+        self.db = self.create_db()
+        assert self.db.table == f"{table}_1"
+        self.load_records(2)
+        assert len(self.db.get_history()) == 2
+
+    def test_batched_commit(self):
+        """writes are committed in batches"""
+        self.db._flush()
+        reader = sqlite3.connect(self.temp_db)
+        query = f"SELECT COUNT(*) FROM '{self.db.table}'"
+        before = reader.execute(query).fetchone()[0]
+        self.db.max_pending_writes = 3
+        self.load_records(2)
+        # not committed yet, but visible to the writer
+        assert reader.execute(query).fetchone()[0] == before
+        assert len(self.db.get_history()) == before + 2
+        self.load_records(1)
+        # hit max_pending_writes
+        assert reader.execute(query).fetchone()[0] == before + 3
+        self.load_records(1)
+        self.db._flush()
+        assert reader.execute(query).fetchone()[0] == before + 4
+        reader.close()
+
+    def test_commit_interval(self):
+        """writes are committed once the transaction is old enough"""
+        self.db._flush()
+        assert self.db._flush_timeout is None
+        self.db.commit_interval = 0.1
+        self.load_records(1)
+        assert self.db._db.in_transaction
+        assert self.db._flush_timeout is not None
+        time.sleep(0.1)
+        self.load_records(1)
+        assert not self.db._db.in_transaction
+        assert self.db._flush_timeout is None
+
+    def test_pragmas(self):
+        journal_mode = self.db._db.execute("PRAGMA journal_mode").fetchone()[0]
+        assert journal_mode == 'wal'
+        # 1 = NORMAL
+        assert self.db._db.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+    def test_journal_mode(self):
+        """the journal mode can be changed, e.g. for network filesystems"""
+        self.db.close()
+        location, fname = os.path.split(self.temp_db)
+        self.db = SQLiteDB(location=location, filename=fname, journal_mode='DELETE')
+        db = self.db._db
+        assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+        # 2 = FULL
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 2
+        msg_id = self.load_records(1)[-1]
+        self.db._flush()
+        assert self.db.get_record(msg_id)['msg_id'] == msg_id
+
+    def test_history_uses_index(self):
+        query = (
+            "EXPLAIN QUERY PLAN "
+            f"SELECT msg_id FROM '{self.db.table}' ORDER BY submitted ASC"
+        )
+        plan = " ".join(row[-1] for row in self.db._db.execute(query))
+        assert f"{self.db.table}_submitted" in plan
+        assert "TEMP B-TREE" not in plan
+
+    def test_read_from_thread(self):
+        """records can be read from another thread"""
+        self.db._flush()
+        msg_id = self.db.get_history()[-1]
+        with ThreadPoolExecutor(1) as pool:
+            rec = pool.submit(self.db.get_record, msg_id).result()
+        assert rec['msg_id'] == msg_id
+
+    def test_read_from_thread_uncommitted(self):
+        """other threads don't use the write connection"""
+        self.db._flush()
+        msg_id = self.load_records(1)[-1]
+        assert self.db._db.in_transaction
+        with ThreadPoolExecutor(1) as pool:
+            with pytest.raises(KeyError):
+                pool.submit(self.db.get_record, msg_id).result()
+            # wait for a pooled connection, rather than using the writer
+            readers = [self.db._pool.get_nowait() for i in range(2)]
+            future = pool.submit(self.db.get_history)
+            time.sleep(0.1)
+            assert not future.done()
+            for db in readers:
+                self.db._pool.put(db)
+            assert msg_id not in future.result()
+        assert self.db.get_record(msg_id)['msg_id'] == msg_id
+
+    def test_iter_records_close(self):
+        """closing a partly consumed iterator returns its connection"""
+        self.db._flush()
+        size = self.db._pool.qsize()
+        it = self.db.iter_records({'msg_id': {'$ne': None}})
+        next(it)
+        assert self.db._pool.qsize() == size - 1
+        it.close()
+        assert self.db._pool.qsize() == size
+
+    def test_parse_nested_dates(self):
+        msg_id = self.db.get_history()[-1]
+        rec = self.db.get_record(msg_id)
+        assert isinstance(rec['header']['date'], str)
+        assert isinstance(rec['submitted'], datetime)
+        self.db.close()
+        location, fname = os.path.split(self.temp_db)
+        self.db = SQLiteDB(
+            location=location,
+            filename=fname,
+            table='nested_dates',
+            parse_nested_dates=True,
+        )
+        msg_id = self.load_records(1)[-1]
+        rec = self.db.get_record(msg_id)
+        assert isinstance(rec['header']['date'], datetime)
+        found = self.db.find_records({'msg_id': msg_id}, keys=['header'])
+        assert isinstance(found[0]['header']['date'], datetime)
+
+    def test_parse_nested_dates_per_instance(self):
+        """parse_nested_dates doesn't affect other instances"""
+        self.db._flush()
+        location, fname = os.path.split(self.temp_db)
+        other = SQLiteDB(
+            location=location,
+            filename=fname,
+            table='nested_dates',
+            parse_nested_dates=True,
+        )
+        try:
+            msg_id = self.db.get_history()[-1]
+            other.add_record(msg_id, self.db.get_record(msg_id))
+            assert isinstance(other.get_record(msg_id)['header']['date'], datetime)
+            assert isinstance(self.db.get_record(msg_id)['header']['date'], str)
+        finally:
+            other.close()
+
+    def test_convert_timestamp(self):
+        now = util.utcnow()
+        assert _convert_timestamp(now.isoformat().encode()) == now
+        # not produced by isoformat, handled by the dateutil fallback
+        dt = _convert_timestamp(b'2020-01-02T03:04:05.678Z')
+        assert dt == datetime(2020, 1, 2, 3, 4, 5, 678000, tzinfo=utc)
+
+    def stored_files(self, msg_id):
+        """The names of the files storing a record's buffers"""
+        if not os.path.isdir(self.db._blob_dir):
+            return []
+        return sorted(
+            name
+            for name in os.listdir(self.db._blob_dir)
+            if name.startswith(f"{msg_id}.")
+        )
+
+    def test_buffers_in_files(self):
+        """large buffers are stored in files"""
+        self.db.blob_threshold = 1000
+        small = self.load_records(1, buffer_size=500)[-1]
+        large = self.load_records(1, buffer_size=2000)[-1]
+        rec = self.db.get_record(large)
+        assert len(self.stored_files(large)) == 1
+        assert self.stored_files(small) == []
+        assert len(rec['buffers']) == 1
+        assert len(rec['buffers'][0]) == 2000
+
+        bufs = [os.urandom(600), b'', memoryview(os.urandom(1200))[::2]]
+        expected = [bytes(b) for b in bufs]
+        self.db.update_record(large, {'result_buffers': bufs})
+        rec = self.db.get_record(large)
+        assert [bytes(b) for b in rec['result_buffers']] == expected
+        self.db._flush()
+        found = self.db.find_records({'msg_id': large})
+        assert [bytes(b) for b in found[0]['result_buffers']] == expected
+
+        self.db.drop_record(large)
+        self.db._flush()
+        assert self.stored_files(large) == []
+        msg_ids = self.load_records(3, buffer_size=2000)
+        self.db.drop_matching_records({'msg_id': {'$in': msg_ids}})
+        self.db._flush()
+        for msg_id in msg_ids:
+            assert self.stored_files(msg_id) == []
+
+    def test_buffer_files_removed_after_commit(self):
+        """files are only removed once the records using them are committed"""
+        self.db.blob_threshold = 1000
+        msg_id = self.load_records(1, buffer_size=2000)[-1]
+        self.db._flush()
+        [before] = self.stored_files(msg_id)
+
+        self.db.update_record(msg_id, {'buffers': [os.urandom(3000)]})
+        # the committed record still uses the old file
+        assert before in self.stored_files(msg_id)
+        assert len(self.stored_files(msg_id)) == 2
+        self.db._flush()
+        [after] = self.stored_files(msg_id)
+        assert after != before
+        assert len(self.db.get_record(msg_id)['buffers'][0]) == 3000
+
+        self.db.drop_record(msg_id)
+        assert self.stored_files(msg_id) == [after]
+        self.db._flush()
+        assert self.stored_files(msg_id) == []
+
+    def test_buffer_files_relative(self):
+        """columns refer to buffer files relative to the blob directory"""
+        self.db.blob_threshold = 1000
+        msg_id = self.load_records(1, buffer_size=2000)[-1]
+        self.db._flush()
+        stored = self.db._blob_files("msg_id == ?", (msg_id,))
+        assert stored == self.stored_files(msg_id)
+        assert not os.path.isabs(stored[0])
+
+    def test_blob_files_skip_inline(self):
+        """finding buffer files doesn't unpack buffers stored inline"""
+        self.db.blob_threshold = 1000
+        large = self.load_records(1, buffer_size=2000)[-1]
+        hist = self.db.get_history()
+        with mock.patch.object(
+            sqlitedb, '_unpack_bufs', side_effect=AssertionError("unpacked")
+        ):
+            stored = self.db._blob_files("msg_id IS NOT NULL", ())
+            assert stored == self.stored_files(large)
+            self.db.drop_matching_records({'msg_id': {'$in': hist}})
+        self.db._flush()
+        assert self.stored_files(large) == []
+
+    def test_buffer_views_once(self):
+        """buffers are only converted to views once"""
+        self.db.blob_threshold = 1000
+        msg_id = self.db.get_history()[-1]
+        bufs = [memoryview(os.urandom(1200))[::2], os.urandom(10)]
+        with mock.patch.object(
+            sqlitedb, '_byte_view', wraps=sqlitedb._byte_view
+        ) as byte_view:
+            self.db.update_record(msg_id, {'result_buffers': bufs})
+        assert byte_view.call_count == len(bufs)
+        rec = self.db.get_record(msg_id)
+        assert [bytes(b) for b in rec['result_buffers']] == [bytes(b) for b in bufs]
+
+    def test_blob_dir_quoted(self):
+        """table names are safe directory names"""
+        self.db.close()
+        location, fname = os.path.split(self.temp_db)
+        self.db = SQLiteDB(location=location, filename=fname, table='../up')
+        blobs = os.path.join(location, f"{fname}-blobs")
+        assert os.path.dirname(self.db._blob_dir) == os.path.abspath(blobs)
+
+    def test_buffer_files_copied(self):
+        """buffers can be copied out of files, rather than mapped"""
+        self.db.blob_threshold = 1000
+        msg_id = self.load_records(1, buffer_size=2000)[-1]
+        with mock.patch.object(sqlitedb, '_MMAP_BUFS', False):
+            rec = self.db.get_record(msg_id)
+        assert isinstance(rec['buffers'][0].obj, bytes)
+        assert len(rec['buffers'][0]) == 2000
+
+    def test_missing_buffer_file(self):
+        """a missing buffer file doesn't prevent reading records"""
+        self.db.blob_threshold = 1000
+        msg_id = self.load_records(1, buffer_size=2000)[-1]
+        for name in self.stored_files(msg_id):
+            os.remove(os.path.join(self.db._blob_dir, name))
+        assert self.db.get_record(msg_id)['buffers'] == []
+        recs = self.db.find_records({'msg_id': {'$ne': None}})
+        assert len(recs) == 17
+        # the record can still be dropped
+        self.db.drop_record(msg_id)
+        self.db._flush()
+        with pytest.raises(KeyError):
+            self.db.get_record(msg_id)
+
+    def test_reuse_table(self):
+        """an existing table in the current format is reused"""
+        table = self.db.table
+        msg_ids = self.db.get_history()
+        self.db.close()
+        self.db = self.create_db()
+        assert self.db.table == table
+        assert self.db.get_history() == msg_ids
+
+    def test_quoted_table(self):
+        self.db.close()
+        location, fname = os.path.split(self.temp_db)
+        self.db = SQLiteDB(location=location, filename=fname, table='odd "name\'')
+        msg_id = self.load_records(1)[-1]
+        assert self.db.get_history() == [msg_id]
+
+    def test_dicts_in_text_columns(self):
+        """dicts in text columns are stored as JSON text"""
+        msg_id = self.db.get_history()[-1]
+        error = {'ename': 'ValueError', 'evalue': 'bad', 'traceback': []}
+        execute_result = {'data': {'text/plain': '5'}, 'execution_count': 1}
+        self.db.update_record(
+            msg_id, {'error': error, 'execute_result': execute_result}
+        )
+        rec = self.db.get_record(msg_id)
+        assert isinstance(rec['error'], str)
+        assert json.loads(rec['error']) == error
+        assert isinstance(rec['execute_result'], str)
+        assert json.loads(rec['execute_result']) == execute_result
+        assert isinstance(rec['content'], dict)
+
+    def test_dict_column_type(self):
+        """dict columns store one type, whichever format is used"""
+        msg_id = self.db.get_history()[-1]
+        self.db.update_record(msg_id, {'result_content': {'x': 2**70}})
+        query = (
+            f"SELECT typeof(content), typeof(result_content) FROM '{self.db.table}'"
+            " WHERE msg_id == ?"
+        )
+        content_type, result_type = self.db._db.execute(query, (msg_id,)).fetchone()
+        assert content_type == result_type
+        if sqlitedb.msgpack is None:
+            assert content_type == 'text'
+
+    def test_list_not_adapted(self):
+        """only buffer columns store lists"""
+        msg_id = self.db.get_history()[-1]
+        with pytest.raises(sqlite3.Error):
+            self.db.update_record(msg_id, {'stdout': ['not', 'buffers']})